@@ -2,11 +2,27 @@
 Package for handling basic file transfer processes
 """
 # Standard Imports
+import hashlib
 import os
 import shutil
+import sqlite3
+import sys
+import time
+import uuid
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Local Imports
 
+# Linux ioctl request to share a source file's extents with a destination file
+FICLONE = 0x40049409
+# Directory listings modified this close to the scan start are not cached, covering the 2 second FAT timestamp resolution
+RACY_MARGIN_NS = 2 * 10**9
+# Scan index schema version, older index files are rebuilt
+SCAN_INDEX_VERSION = 3
+
 
 def drop_period_extension(file_extensions: list) -> list:
     """
@@ -31,7 +47,180 @@ def drop_period_extension(file_extensions: list) -> list:
     return modified_extensions
 
 
-def get_files(filepath: str, include_extensions: list = [], exclude_extensions: list = []) -> tuple:
+def open_scan_index(index_filepath: str) -> sqlite3.Connection:
+    """
+    Opens the on-disk scan index, creating its tables if they do not exist  
+    Paths and names are stored as BLOB so filenames that are not valid UTF-8 can be indexed  
+    Each directory listing is one row with its names joined by NUL, which cannot appear in a filename
+
+    Parameters
+    ----------
+    index_filepath: str
+        Filepath of the SQLite scan index
+
+    Returns
+    -------
+    sqlite3.Connection
+        Connection to the scan index
+    """
+    connection = sqlite3.connect(index_filepath)
+    # Rebuild index files written with an older schema
+    if connection.execute("PRAGMA user_version").fetchone()[0] != SCAN_INDEX_VERSION:
+        connection.execute("DROP TABLE IF EXISTS directories")
+        connection.execute("DROP TABLE IF EXISTS entries")
+        connection.execute("PRAGMA user_version = %d" % SCAN_INDEX_VERSION)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS directories ("
+        "path BLOB PRIMARY KEY, mtime_ns INTEGER NOT NULL, ctime_ns INTEGER NOT NULL, ino INTEGER NOT NULL, "
+        "dirnames BLOB NOT NULL, filenames BLOB NOT NULL, linknames BLOB NOT NULL)"
+    )
+    connection.commit()
+    return connection
+
+
+def join_names(names: list) -> bytes:
+    """
+    Joins directory entry names into one scan index BLOB
+
+    Parameters
+    ----------
+    names: list
+        Directory entry names
+
+    Returns
+    -------
+    bytes
+        Encoded names separated by NUL
+    """
+    return os.fsencode("\0".join(names))
+
+
+def split_names(names: bytes) -> list:
+    """
+    Splits a scan index BLOB back into directory entry names
+
+    Parameters
+    ----------
+    names: bytes
+        Encoded names separated by NUL
+
+    Returns
+    -------
+    list
+        Directory entry names
+    """
+    return os.fsdecode(names).split("\0") if names else []
+
+
+def indexed_walk(filepath: str, index_filepath: str) -> list:
+    """
+    Walks the filepath like os.walk, reusing directory listings from the scan index  
+    Only directories whose modification time, change time or inode changed since the last scan are re-listed  
+    Whether a symlink points to a directory is checked on every scan, as its target may change outside the filepath  
+    Only names are cached, files are not stat'ed since in-place changes do not update the directory modification time  
+    Listings of directories modified within RACY_MARGIN_NS of the scan start are not cached, as later changes may keep the same modification time  
+    Index records are keyed by normalized absolute paths, while returned paths keep the spelling of the filepath  
+    The index file and its SQLite journal files are left out when the index lives inside the filepath  
+    Cached listings below the filepath are loaded in one query and walked in memory
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath to walk
+    index_filepath: str
+        Filepath of the SQLite scan index, created if it does not exist
+
+    Returns
+    -------
+    list
+        List of (dirpath, dirnames, filenames) tuples in top-down order
+    """
+    connection = open_scan_index(index_filepath)
+    try:
+        scan_start_ns = time.time_ns()
+        root_dirpath = os.path.normcase(os.path.abspath(filepath))
+        # The index file and its SQLite journal files are never part of the scan
+        index_dirpath, index_filename = os.path.split(os.path.normcase(os.path.abspath(index_filepath)))
+        index_filenames = [index_filename + suffix for suffix in ["", "-journal", "-wal", "-shm"]]
+        # Load every cached directory listing below the filepath in one query
+        root_prefix = os.fsencode(os.path.join(root_dirpath, ""))
+        # Keys below the filepath sort between the prefix and the prefix with its separator incremented
+        cached_listings = {
+            os.fsdecode(path): row for path, *row in connection.execute(
+                "SELECT path, mtime_ns, ctime_ns, ino, dirnames, filenames, linknames FROM directories "
+                "WHERE path = ? OR (path >= ? AND path < ?)",
+                (os.fsencode(root_dirpath), root_prefix, root_prefix[:-1] + bytes([root_prefix[-1] + 1]))
+            )
+        }
+        walked = []
+        visited = set()
+        changed_dirpaths = []
+        listing_records = []
+        # Pending directories as (index key, path in the spelling of the filepath)
+        pending = [(root_dirpath, filepath)]
+        while pending:
+            dirpath, walked_dirpath = pending.pop()
+            try:
+                dir_stat = os.stat(dirpath)
+            except OSError:
+                continue
+            dir_stats = [dir_stat.st_mtime_ns, dir_stat.st_ctime_ns, dir_stat.st_ino]
+            visited.add(dirpath)
+            cached_listing = cached_listings.get(dirpath)
+            if cached_listing is not None and cached_listing[:3] == dir_stats:
+                # Directory unchanged, reuse the cached listing
+                dirnames, filenames, linknames = [split_names(names) for names in cached_listing[3:]]
+            else:
+                # Directory changed or unseen, re-list it and refresh the cached listing
+                dirnames, filenames, linknames = [], [], []
+                try:
+                    with os.scandir(dirpath) as iterator:
+                        for entry in iterator:
+                            if dirpath == index_dirpath and os.path.normcase(entry.name) in index_filenames:
+                                continue
+                            try:
+                                if entry.is_symlink():
+                                    linknames.append(entry.name)
+                                elif entry.is_dir():
+                                    dirnames.append(entry.name)
+                                else:
+                                    filenames.append(entry.name)
+                            except OSError:
+                                filenames.append(entry.name)
+                except OSError:
+                    continue
+                dirnames.sort()
+                filenames.sort()
+                linknames.sort()
+                changed_dirpaths.append((os.fsencode(dirpath),))
+                # Only cache listings whose modification time is safely older than the scan start
+                if dir_stat.st_mtime_ns < scan_start_ns - RACY_MARGIN_NS:
+                    listing_records.append(
+                        [os.fsencode(dirpath)] + dir_stats + [join_names(names) for names in [dirnames, filenames, linknames]]
+                    )
+            # Symlinks are not walked into, but are reported as directories when they point to one
+            walked_dirnames = list(dirnames)
+            walked_filenames = list(filenames)
+            for linkname in linknames:
+                if os.path.isdir(os.path.join(dirpath, linkname)):
+                    walked_dirnames.append(linkname)
+                else:
+                    walked_filenames.append(linkname)
+            walked.append((walked_dirpath, walked_dirnames, walked_filenames))
+            # Push subdirectories in reverse so they are walked in listing order
+            pending.extend(reversed([
+                (os.path.join(dirpath, os.path.normcase(name)), os.path.join(walked_dirpath, name)) for name in dirnames
+            ]))
+        # Refresh re-listed directories and drop directories below the filepath that no longer exist
+        changed_dirpaths.extend([(os.fsencode(dirpath),) for dirpath in cached_listings if dirpath not in visited])
+        connection.executemany("DELETE FROM directories WHERE path = ?", changed_dirpaths)
+        connection.executemany("INSERT INTO directories VALUES (?, ?, ?, ?, ?, ?, ?)", listing_records)
+        connection.commit()
+    finally:
+        connection.close()
+    return walked
+
+def get_files(filepath: str, include_extensions: list = [], exclude_extensions: list = [], index_filepath: str = None) -> tuple:
     """
     Retrieves all files within the filepath with specified file extension excluding any specified file extensions
 
@@ -45,6 +234,9 @@ def get_files(filepath: str, include_extensions: list = [], exclude_extensions:
     exclude_extensions: list = [str]
         File extensions to exclude in retrieval  
         Will exclude none if none specified
+    index_filepath: str = None
+        Filepath of an on-disk scan index to reuse unchanged directory listings  
+        Will walk the whole filepath if none specified
 
     Returns
     -------
@@ -57,6 +249,7 @@ def get_files(filepath: str, include_extensions: list = [], exclude_extensions:
     assert type(exclude_extensions) is list, "exclude_extensions must be a list"
     assert all([type(extension) is str for extension in include_extensions]), "File extentions must be strings"
     assert all([type(extension) is str for extension in exclude_extensions]), "File extentions must be strings"
+    assert index_filepath is None or type(index_filepath) is str, "index_filepath must be a string"
     # Modify all extensions to drop period if included
     include_extensions = drop_period_extension(include_extensions)
     exclude_extensions = drop_period_extension(exclude_extensions)
@@ -64,8 +257,12 @@ def get_files(filepath: str, include_extensions: list = [], exclude_extensions:
     retrieved_filenames = []
     # List of all full filepaths retrieved
     retrieved_filepaths = []
-    # Walk the filepath to retrieve files
-    for dirpath, _, filenames in os.walk(filepath):
+    # Walk the filepath to retrieve files, through the scan index if specified
+    if index_filepath is not None:
+        walked = indexed_walk(filepath, index_filepath)
+    else:
+        walked = os.walk(filepath)
+    for dirpath, _, filenames in walked:
         # Loop over all files in the directory
         for filename in filenames:
             # If included file extensions are specified
@@ -84,7 +281,120 @@ def get_files(filepath: str, include_extensions: list = [], exclude_extensions:
     return retrieved_filenames, retrieved_filepaths
 
 
-def transfer_files(src: str, des: str, include_extensions: list = [], exclude_extensions: list = [], overwrite: bool = False):
+def hash_file(filepath: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Hashes the contents of a file
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath of the file to hash
+    chunk_size: int = 1048576
+        Number of bytes read at a time
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_duplicate_files(filepaths: list) -> dict:
+    """
+    Finds files with identical contents, grouping by size first and hashing only files that share a size  
+    Empty files are never reported as duplicates
+
+    Parameters
+    ----------
+    filepaths: list
+        Filepaths to search for duplicates
+
+    Returns
+    -------
+    dict
+        Mapping of each duplicate filepath to the first filepath with the same contents
+    """
+    # Group filepaths by file size
+    size_groups = {}
+    for filepath in filepaths:
+        size = os.path.getsize(filepath)
+        if size > 0:
+            size_groups.setdefault(size, []).append(filepath)
+    # Hash only filepaths whose size collides with another
+    duplicates = {}
+    for size_group in size_groups.values():
+        if len(size_group) < 2:
+            continue
+        originals = {}
+        for filepath in size_group:
+            digest = hash_file(filepath)
+            if digest in originals:
+                duplicates[filepath] = originals[digest]
+            else:
+                originals[digest] = filepath
+    return duplicates
+
+
+def link_file(src: str, des: str, link_type: str) -> bool:
+    """
+    Links the destination to the contents of an already transferred file, copying if linking is not supported  
+    Reflinks use the Linux FICLONE ioctl and are copied on other platforms
+
+    Parameters
+    ----------
+    src: str
+        Filepath of the already transferred file
+    des: str
+        Filepath of the file to create
+    link_type: str
+        Either "hardlink" or "reflink"
+
+    Returns
+    -------
+    bool
+        Whether the destination was linked rather than copied
+    """
+    if link_type == "hardlink":
+        try:
+            os.link(src, des)
+            return True
+        except OSError:
+            pass
+    elif link_type == "reflink" and sys.platform.startswith("linux") and fcntl is not None:
+        try:
+            with open(src, "rb") as src_file, open(des, "wb") as des_file:
+                fcntl.ioctl(des_file.fileno(), FICLONE, src_file.fileno())
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(src, des)
+    return False
+
+
+def temporary_filepath(filepath: str) -> str:
+    """
+    Creates an unused hidden filepath next to the filepath to write to before replacing it
+
+    Parameters
+    ----------
+    filepath: str
+        Filepath that will be replaced
+
+    Returns
+    -------
+    str
+        Temporary filepath in the same directory
+    """
+    dirpath, filename = os.path.split(filepath)
+    return os.path.join(dirpath, ".%s.%s.tmp" % (filename, uuid.uuid4().hex)).replace("\\", "/")
+
+
+def transfer_files(src: str, des: str, include_extensions: list = [], exclude_extensions: list = [], overwrite: bool = False, index_filepath: str = None, deduplicate: str = None):
     """
     Transfer all files and folder structure from source to destination
 
@@ -100,6 +410,11 @@ def transfer_files(src: str, des: str, include_extensions: list = [], exclude_ex
         File extensions to exclude in the transfer
     overwrite: bool = False
         Whether to overwrite files if they already exist in destination
+    index_filepath: str = None
+        Filepath of an on-disk scan index used when retrieving source files
+    deduplicate: str = None
+        Copy each unique file content once and link later duplicates, either "hardlink" or "reflink"  
+        Will copy every file if none specified
     """
     # Assert that arguments are the correct format
     assert type(src) is str, "Source filepath must be a string"
@@ -108,6 +423,8 @@ def transfer_files(src: str, des: str, include_extensions: list = [], exclude_ex
     assert type(exclude_extensions) is list, "Excluded extensions must be a list"
     assert all([type(extension) is str for extension in include_extensions]), "All included extensions must be strings"
     assert all([type(extension) is str for extension in exclude_extensions]), "All excluded extensions must be strings"
+    assert index_filepath is None or type(index_filepath) is str, "Index filepath must be a string"
+    assert deduplicate in [None, "hardlink", "reflink"], "Deduplicate must be None, hardlink or reflink"
     # Modify all extensions to drop period if included
     include_extensions = drop_period_extension(include_extensions)
     exclude_extensions = drop_period_extension(exclude_extensions)
@@ -115,7 +432,7 @@ def transfer_files(src: str, des: str, include_extensions: list = [], exclude_ex
     src = src.replace("\\", "/")
     des = des.replace("\\", "/")
     # Get all filepaths from source to transfer
-    _, src_filepaths = get_files(src, include_extensions=include_extensions, exclude_extensions=exclude_extensions)
+    _, src_filepaths = get_files(src, include_extensions=include_extensions, exclude_extensions=exclude_extensions, index_filepath=index_filepath)
     # Modify all filepaths to be sure path delimiter is the same
     src_filepaths = [filepath.replace("\\", "/") for filepath in src_filepaths]
     # Create list of relative filepaths
@@ -127,7 +444,22 @@ def transfer_files(src: str, des: str, include_extensions: list = [], exclude_ex
     if not overwrite:
         if any([os.path.exists(filepath) for filepath in des_filepaths]):
             raise Exception("File already exists in destination filepath, consider setting overwrite to True")
+    # Find source files whose contents were already transferred
+    duplicates = find_duplicate_files(src_filepaths) if deduplicate is not None else {}
+    src_to_des = dict(zip(src_filepaths, des_filepaths))
     # Transfer files
     for src_filepath, des_filepath in zip(src_filepaths, des_filepaths):
         os.makedirs(os.path.dirname(des_filepath), exist_ok=True)
-        shutil.copyfile(src_filepath, des_filepath)
+        # Write to a temporary file and replace the destination, so a failed write keeps the existing file
+        # and an existing hardlinked destination is never written through
+        des_temp_filepath = temporary_filepath(des_filepath)
+        try:
+            if src_filepath in duplicates:
+                link_file(src_to_des[duplicates[src_filepath]], des_temp_filepath, deduplicate)
+            else:
+                shutil.copyfile(src_filepath, des_temp_filepath)
+            os.replace(des_temp_filepath, des_filepath)
+        except BaseException:
+            if os.path.lexists(des_temp_filepath):
+                os.remove(des_temp_filepath)
+            raise
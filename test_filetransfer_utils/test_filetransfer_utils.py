@@ -4,6 +4,9 @@ Unit testing of the file_transfer package
 # Standard Imports
 import os
 import shutil
+import sqlite3
+import sys
+import time
 import pytest
 
 # Local Imports
@@ -12,6 +15,7 @@ import filetransfer_utils.file_transfer as file_transfer
 # Environment variables
 dummy_src = os.path.join(os.getcwd(), "Temp_src")
 dummy_des = os.path.join(os.getcwd(), "Temp_des")
+dummy_index = os.path.join(os.getcwd(), "Temp_index.db")
 dummy_dirs = ["A", "B", "C"]
 dummy_files = ["A.txt", "B.png", "C.bin", "D.jpg"]
 
@@ -63,6 +67,15 @@ def clear_src_des_dummy_dirs():
             pass
 
 
+def pin_src_dummy_dir_mtimes():
+    """
+    Pins the modification time of the source dummy directories to an hour ago so their listings are cached
+    """
+    pinned_ns = time.time_ns() - 3600 * 10**9
+    for dirpath in [dummy_src] + [os.path.join(dummy_src, dummy_dir) for dummy_dir in dummy_dirs]:
+        os.utime(dirpath, ns=(pinned_ns, pinned_ns))
+
+
 class TestDropPeriodExtensions:
     """
     Tests that drop period extensions method returns correct file extensions
@@ -270,6 +283,171 @@ class TestGetFiles:
             raise Exception("get_files did not return correct files with specified file extension inclusion from whole directory")
 
 
+class TestGetFilesIndex:
+    """
+    Tests that get files method with a scan index returns appropriate output
+    """
+
+    def setup_method(self):
+        """
+        Populates the source directory with dummy data
+        """
+        populate_src_dummy_dir()
+
+    def teardown_method(self):
+        """
+        Clears the source directory of dummy data and removes the scan index
+        """
+        clear_src_des_dummy_dirs()
+        try:
+            os.remove(dummy_index)
+        except FileNotFoundError:
+            pass
+
+    def test_index_filepath_not_str(self):
+        """
+        Test that the index filepath must be a string
+        """
+        with pytest.raises(AssertionError):
+            _ = file_transfer.get_files(
+                filepath=dummy_src,
+                index_filepath=1
+            )
+
+    def test_get_directory_index(self):
+        """
+        Tests that the indexed scan retrieves the same files as a full walk, before and after the index exists
+        """
+        pin_src_dummy_dir_mtimes()
+        _, walked_filepaths = file_transfer.get_files(dummy_src)
+        _, first_filepaths = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        _, second_filepaths = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        if not os.path.exists(dummy_index):
+            raise Exception("get_files did not create the scan index")
+        elif not sorted(first_filepaths) == sorted(walked_filepaths):
+            raise Exception("get_files did not return correct files when creating the scan index")
+        elif not sorted(second_filepaths) == sorted(walked_filepaths):
+            raise Exception("get_files did not return correct files when reusing the scan index")
+
+    def test_get_directory_index_changed(self):
+        """
+        Tests that the indexed scan picks up added files and removed directories
+        """
+        pin_src_dummy_dir_mtimes()
+        _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        with open(os.path.join(dummy_src, dummy_dirs[0], "E.csv"), "w"):
+            pass
+        shutil.rmtree(os.path.join(dummy_src, dummy_dirs[1]))
+        filenames, filepaths = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        if "E.csv" not in filenames:
+            raise Exception("get_files did not pick up file added since the scan index was created")
+        elif not len(filepaths) == 9:
+            raise Exception("get_files did not drop directory removed since the scan index was created")
+        elif not all([os.path.exists(filepath) for filepath in filepaths]):
+            raise Exception("get_files returned stale filepaths from the scan index")
+
+    def test_get_directory_index_racy(self):
+        """
+        Tests that a file added within the directory timestamp resolution of a scan is picked up by later scans
+        """
+        single_directory = os.path.join(dummy_src, dummy_dirs[0])
+        dir_stat = os.stat(single_directory)
+        _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        with open(os.path.join(single_directory, "E.csv"), "w"):
+            pass
+        # Pin the directory modification time as a coarse timestamp filesystem would leave it
+        os.utime(single_directory, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        filenames, _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        if "E.csv" not in filenames:
+            raise Exception("get_files did not pick up file added within the timestamp resolution of the previous scan")
+
+    def test_get_directory_index_spellings(self):
+        """
+        Tests that differently spelled filepaths share index records and return paths in their own spelling
+        """
+        pin_src_dummy_dir_mtimes()
+        _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        rel_src = os.path.relpath(dummy_src)
+        for spelling in [rel_src, os.path.join(".", rel_src), os.path.join(rel_src, "")]:
+            _, walked_filepaths = file_transfer.get_files(spelling)
+            _, indexed_filepaths = file_transfer.get_files(spelling, index_filepath=dummy_index)
+            if not sorted(indexed_filepaths) == sorted(walked_filepaths):
+                raise Exception("get_files did not return paths in the spelling of the filepath")
+        connection = sqlite3.connect(dummy_index)
+        indexed_dirpaths = [path for path, in connection.execute("SELECT path FROM directories")]
+        connection.close()
+        if not len(indexed_dirpaths) == len(dummy_dirs) + 1:
+            raise Exception("get_files did not share index records between filepath spellings")
+
+    def test_get_directory_index_inside_filepath(self):
+        """
+        Tests that a scan index inside the filepath is left out of the retrieved files
+        """
+        _, walked_filepaths = file_transfer.get_files(dummy_src)
+        inner_index = os.path.join(dummy_src, dummy_dirs[0], "Temp_index.db")
+        for _ in range(2):
+            filenames, _ = file_transfer.get_files(dummy_src, index_filepath=inner_index)
+            if not len(filenames) == len(walked_filepaths):
+                raise Exception("get_files retrieved the scan index from inside the filepath")
+            elif any([filename.startswith("Temp_index.db") for filename in filenames]):
+                raise Exception("get_files retrieved the scan index from inside the filepath")
+
+    def test_get_directory_index_swapped(self):
+        """
+        Tests that the indexed scan picks up a directory replaced by a copy with the same modification time
+        """
+        single_directory = os.path.join(dummy_src, dummy_dirs[0])
+        pin_src_dummy_dir_mtimes()
+        _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        dir_stat = os.stat(single_directory)
+        shutil.copytree(single_directory, single_directory + "_copy")
+        with open(os.path.join(single_directory + "_copy", "E.csv"), "w"):
+            pass
+        shutil.rmtree(single_directory)
+        os.rename(single_directory + "_copy", single_directory)
+        # Restore the modification times as cp -a, tar x or rsync -a would
+        os.utime(single_directory, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        os.utime(dummy_src, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        filenames, _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        if "E.csv" not in filenames:
+            raise Exception("get_files reused the cached listing of a swapped directory")
+
+    @pytest.mark.skipif(os.name == "nt", reason="Creating symlinks requires privileges on Windows")
+    def test_get_directory_index_symlink_target_changed(self):
+        """
+        Tests that the indexed scan picks up a symlink whose target changed from a directory to a file
+        """
+        link_target = os.path.join(dummy_des, dummy_dirs[0])
+        os.makedirs(link_target, exist_ok=True)
+        os.symlink(link_target, os.path.join(dummy_src, dummy_dirs[0], "E.lnk"))
+        pin_src_dummy_dir_mtimes()
+        _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        os.rmdir(link_target)
+        with open(link_target, "w"):
+            pass
+        filenames, _ = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+        os.remove(link_target)
+        if "E.lnk" not in filenames:
+            raise Exception("get_files did not pick up symlink whose target changed to a file")
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Filenames that are not valid UTF-8 require Linux")
+    def test_get_directory_index_undecodable_name(self):
+        """
+        Tests that the indexed scan handles filenames that are not valid UTF-8, before and after the index exists
+        """
+        undecodable_filename = os.fsdecode(b"bad\xffname.txt")
+        with open(os.path.join(dummy_src, dummy_dirs[0], undecodable_filename), "w"):
+            pass
+        pin_src_dummy_dir_mtimes()
+        _, walked_filepaths = file_transfer.get_files(dummy_src)
+        for _ in range(2):
+            filenames, indexed_filepaths = file_transfer.get_files(dummy_src, index_filepath=dummy_index)
+            if undecodable_filename not in filenames:
+                raise Exception("get_files did not retrieve filename that is not valid UTF-8 through the scan index")
+            elif not sorted(indexed_filepaths) == sorted(walked_filepaths):
+                raise Exception("get_files did not return correct files with filename that is not valid UTF-8")
+
+
 class TestTransferFilesAssertions:
     """
     Tests that transfer files method returns assertion errors for edge cases
@@ -510,3 +688,128 @@ class TestTransferFiles:
             raise Exception("transfer_files did not transfer all files with inclusion")
         elif len([os.path.basename(os.path.dirname(filepath)) == "A" for filepath in filepaths]) == 2:
             raise Exception("transfer_files did not transfer folder structure with inclusion")
+
+
+class TestTransferFilesDeduplicate:
+    """
+    Test the transfer files method with deduplication
+    """
+
+    def setup_method(self):
+        """
+        Populates the source directory with dummy data where every directory holds the same contents
+        """
+        populate_src_dummy_dir()
+        for dummy_dir in dummy_dirs:
+            for dummy_file in dummy_files:
+                with open(os.path.join(dummy_src, dummy_dir, dummy_file), "w") as file:
+                    file.write(dummy_file)
+
+    def teardown_method(self):
+        """
+        Clears the source directory of dummy data
+        """
+        clear_src_des_dummy_dirs()
+
+    def test_deduplicate_invalid(self):
+        """
+        Test that deduplicate must be None, hardlink or reflink
+        """
+        with pytest.raises(AssertionError):
+            _ = file_transfer.transfer_files(
+                src=dummy_src,
+                des=dummy_des,
+                deduplicate="copy"
+            )
+
+    def test_find_duplicate_files(self):
+        """
+        Tests that only later files with identical contents are reported as duplicates
+        """
+        _, filepaths = file_transfer.get_files(dummy_src)
+        duplicates = file_transfer.find_duplicate_files(filepaths)
+        if not len(duplicates) == 8:
+            raise Exception("find_duplicate_files did not find all duplicate files")
+        elif not all([os.path.basename(duplicate) == os.path.basename(original) for duplicate, original in duplicates.items()]):
+            raise Exception("find_duplicate_files matched files with different contents")
+
+    @pytest.mark.parametrize("deduplicate", ["hardlink", "reflink"])
+    def test_transfer_directory_deduplicate(self, deduplicate):
+        """
+        Tests that all files are transferred with correct contents when deduplicating  
+        Passes when links fall back to copies, linking itself is covered by the hardlink and reflink tests
+        """
+        file_transfer.transfer_files(dummy_src, dummy_des, deduplicate=deduplicate)
+        _, filepaths = file_transfer.get_files(dummy_des)
+        if len(filepaths) != 12:
+            raise Exception("transfer_files did not transfer all files when deduplicating")
+        for filepath in filepaths:
+            with open(filepath) as file:
+                if file.read() != os.path.basename(filepath):
+                    raise Exception("transfer_files did not transfer correct contents when deduplicating")
+
+    def test_link_file_reflink(self):
+        """
+        Tests that reflinked files share contents, skipped where the platform or filesystem does not support reflinks
+        """
+        src_filepath = os.path.join(dummy_src, dummy_dirs[0], dummy_files[0])
+        des_filepath = os.path.join(dummy_src, dummy_dirs[0], "E.txt")
+        if not file_transfer.link_file(src_filepath, des_filepath, "reflink"):
+            pytest.skip("Reflinks are not supported here, link_file fell back to a copy")
+        with open(des_filepath) as file:
+            if file.read() != dummy_files[0]:
+                raise Exception("link_file did not reflink file contents")
+
+    def test_transfer_directory_hardlink(self):
+        """
+        Tests that duplicate files are hardlinked at the destination and overwriting does not write through links
+        """
+        file_transfer.transfer_files(dummy_src, dummy_des, deduplicate="hardlink")
+        des_filepaths = [os.path.join(dummy_des, dummy_dir, dummy_files[0]) for dummy_dir in dummy_dirs]
+        if not all([os.path.samefile(des_filepaths[0], filepath) for filepath in des_filepaths]):
+            raise Exception("transfer_files did not hardlink duplicate files")
+        with open(os.path.join(dummy_src, dummy_dirs[-1], dummy_files[0]), "w") as file:
+            file.write("changed")
+        file_transfer.transfer_files(dummy_src, dummy_des, overwrite=True, deduplicate="hardlink")
+        with open(des_filepaths[0]) as file:
+            if file.read() != dummy_files[0]:
+                raise Exception("transfer_files overwrote a hardlinked duplicate")
+        with open(des_filepaths[-1]) as file:
+            if file.read() != "changed":
+                raise Exception("transfer_files did not overwrite changed file")
+
+    def test_transfer_directory_hardlink_then_copy(self):
+        """
+        Tests that an overwrite without deduplication does not write through hardlinks left by a deduplicated transfer
+        """
+        file_transfer.transfer_files(dummy_src, dummy_des, deduplicate="hardlink")
+        for dummy_dir in dummy_dirs:
+            with open(os.path.join(dummy_src, dummy_dir, dummy_files[0]), "w") as file:
+                file.write(dummy_dir)
+        file_transfer.transfer_files(dummy_src, dummy_des, overwrite=True)
+        for dummy_dir in dummy_dirs:
+            with open(os.path.join(dummy_des, dummy_dir, dummy_files[0])) as file:
+                if file.read() != dummy_dir:
+                    raise Exception("transfer_files overwrite wrote through a hardlinked duplicate")
+
+    def test_transfer_directory_failed_overwrite(self, monkeypatch):
+        """
+        Tests that a failed overwrite keeps the existing destination files and leaves no temporary files
+        """
+        file_transfer.transfer_files(dummy_src, dummy_des)
+
+        def failing_copyfile(src, des):
+            with open(des, "w") as file:
+                file.write("partial")
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(file_transfer.shutil, "copyfile", failing_copyfile)
+        with pytest.raises(OSError):
+            file_transfer.transfer_files(dummy_src, dummy_des, overwrite=True)
+        filenames, filepaths = file_transfer.get_files(dummy_des)
+        if len(filepaths) != 12:
+            raise Exception("transfer_files left temporary files or removed destination files after a failed overwrite")
+        for filepath in filepaths:
+            with open(filepath) as file:
+                if file.read() != os.path.basename(filepath):
+                    raise Exception("transfer_files did not keep the existing destination file after a failed overwrite")